@@ -4,7 +4,7 @@ One-time setup script to download and configure high-quality tactical puzzles fr
 
 This script:
 1. Downloads the Lichess puzzle database
-2. Extracts puzzles for each tactical pattern
+2. Extracts puzzles for each tactical pattern (streamed straight from the .zst)
 3. Converts them to our JSON fixture format
 4. Validates them with our tactical library
 5. Creates a marker file to indicate setup is complete
@@ -13,27 +13,62 @@ Usage:
     python3 scripts/setup_tactical_puzzles.py
 """
 
-import os
+import io
 import sys
 import json
 import csv
+import time
+import heapq
+import shutil
+import queue
+import threading
+import multiprocessing
 import subprocess
-import urllib.request
+from concurrent.futures import Future, ProcessPoolExecutor
+from functools import lru_cache, reduce
+from operator import or_
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterator, Optional, Tuple
 
 # Add parent directory to path to import chess libraries
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
 try:
     import chess
-    import chess.pgn
 except ImportError:
     print("❌ Error: python-chess library not found.")
     print("Installing python-chess...")
     subprocess.check_call([sys.executable, "-m", "pip", "install", "python-chess"])
     import chess
-    import chess.pgn
+
+try:
+    import zstandard
+except ImportError:
+    print("❌ Error: zstandard library not found.")
+    print("Installing zstandard...")
+    subprocess.check_call([sys.executable, "-m", "pip", "install", "zstandard"])
+    import zstandard
+
+try:
+    import requests
+except ImportError:
+    print("❌ Error: requests library not found.")
+    print("Installing requests...")
+    subprocess.check_call([sys.executable, "-m", "pip", "install", "requests"])
+    import requests
+
+# pandas is optional: when available the numeric quality filters run as
+# vectorized masks over large chunks instead of row by row in Python
+try:
+    import pandas
+except ImportError:
+    pandas = None
+
+# orjson is optional too: a much faster drop-in for encoding fixtures
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Configuration
 LICHESS_PUZZLE_URL = "https://database.lichess.org/lichess_db_puzzle.csv.zst"
@@ -53,125 +88,478 @@ PATTERN_THEMES = {
     "trapped_piece": ["trappedPiece"],
 }
 
+# Every Lichess theme we care about gets one bit, and each pattern the OR
+# of its themes' bits, so matching a row against all patterns is a few ANDs
+THEME_BITS = {
+    theme: 1 << i
+    for i, theme in enumerate(dict.fromkeys(t for themes in PATTERN_THEMES.values() for t in themes))
+}
+PATTERN_MASKS = {
+    pattern: reduce(or_, (THEME_BITS[t] for t in themes))
+    for pattern, themes in PATTERN_THEMES.items()
+}
+ALL_THEMES_MASK = reduce(or_, THEME_BITS.values())
+
 # Quality criteria
 MIN_POPULARITY = 50
 MIN_RATING = 800   # Easy puzzles start here
 MAX_RATING = 2200  # Hard puzzles go up to here
 MIN_PLAYS = 50
 
+# Download retry behaviour (partial downloads are resumed, not restarted)
+DOWNLOAD_RETRIES = 5
+DOWNLOAD_RETRY_DELAY = 5  # seconds
+DOWNLOAD_TIMEOUT = 60  # seconds without data before a request counts as stalled
+
 # Default number of puzzles per pattern (can be overridden via command line)
 DEFAULT_PUZZLES_PER_PATTERN = 20
 
+# Rows handed from the extraction thread to the conversion pool are
+# buffered in a bounded queue so the reader can't run arbitrarily far ahead
+PIPELINE_QUEUE_SIZE = 1024
+
+# Rows per chunk when filtering the database with pandas
+PANDAS_CHUNK_SIZE = 200_000
+
+# Default read buffer for the compressed database, in MB (can be overridden via command line)
+DEFAULT_READ_BUFFER_MB = 16
+
 
-def check_zstd_installed() -> bool:
-    """Check if zstd is installed for decompression."""
+def _download_meta_file(dest: Path) -> Path:
+    """Sidecar file remembering which remote file a partial download belongs to."""
+    return dest.with_name(dest.name + ".json")
+
+
+def _read_download_meta(dest: Path) -> Dict[str, Any]:
     try:
-        subprocess.run(["zstd", "--version"], capture_output=True, check=True)
-        return True
-    except (subprocess.CalledProcessError, FileNotFoundError):
-        return False
+        with open(_download_meta_file(dest), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
 
 
-def install_zstd():
-    """Attempt to install zstd."""
-    print("📦 Installing zstd...")
-    
-    # Detect OS and install accordingly
-    if sys.platform == "darwin":  # macOS
-        try:
-            subprocess.check_call(["brew", "install", "zstd"])
-            print("✅ zstd installed successfully via Homebrew")
-        except (subprocess.CalledProcessError, FileNotFoundError):
-            print("❌ Failed to install zstd. Please install Homebrew first:")
-            print("   /bin/bash -c \"$(curl -fsSL https://raw.githubusercontent.com/Homebrew/install/HEAD/install.sh)\"")
-            sys.exit(1)
-    elif sys.platform.startswith("linux"):
-        try:
-            # Try apt-get (Debian/Ubuntu)
-            subprocess.check_call(["sudo", "apt-get", "update"])
-            subprocess.check_call(["sudo", "apt-get", "install", "-y", "zstd"])
-            print("✅ zstd installed successfully via apt-get")
-        except (subprocess.CalledProcessError, FileNotFoundError):
-            print("❌ Failed to install zstd. Please install it manually:")
-            print("   Debian/Ubuntu: sudo apt-get install zstd")
-            print("   Fedora/RHEL: sudo dnf install zstd")
-            sys.exit(1)
-    else:
-        print("❌ Unsupported OS. Please install zstd manually:")
-        print("   Windows: Download from https://github.com/facebook/zstd/releases")
-        sys.exit(1)
+def _discard_partial_download(dest: Path):
+    for path in (dest, _download_meta_file(dest)):
+        if path.exists():
+            path.unlink()
+
+
+def _content_range_total(content_range: Optional[str]) -> Optional[int]:
+    """Total size from a 'bytes start-end/total' or 'bytes */total' header."""
+    if not content_range or '/' not in content_range:
+        return None
+    total = content_range.rsplit('/', 1)[1].strip()
+    return int(total) if total.isdigit() else None
+
+
+def _download_with_resume(url: str, dest: Path):
+    """Download url to dest, resuming from a partial file if one exists.
+
+    The ETag (or Last-Modified) of the first response is stored next to the
+    partial file and sent back as If-Range when resuming, so if the remote
+    file changed in the meantime the server answers with the full new file
+    instead of appending its tail to the old one. Returns only once dest has
+    the expected size.
+    """
+    with requests.Session() as session:
+        for attempt in range(1, DOWNLOAD_RETRIES + 1):
+            meta = _read_download_meta(dest)
+            validator = meta.get('etag') or meta.get('last_modified')
+            start = dest.stat().st_size if dest.exists() else 0
+
+            if start > 0 and not validator:
+                # No way to tell whether this partial file matches the remote one
+                print("   Partial download can't be verified, restarting download...")
+                _discard_partial_download(dest)
+                start = 0
 
+            headers = {'Range': f'bytes={start}-', 'If-Range': validator} if start > 0 else {}
 
-def download_puzzle_database() -> Path:
-    """Download the Lichess puzzle database."""
+            try:
+                with session.get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as r:
+                    if r.status_code == 416:
+                        # Nothing left to fetch - only complete if the sizes agree
+                        total = _content_range_total(r.headers.get('Content-Range')) or meta.get('total')
+                        if total is not None and start == total:
+                            return
+                        print("   Partial download doesn't match the remote file, restarting download...")
+                        _discard_partial_download(dest)
+                        continue
+                    r.raise_for_status()
+
+                    total = None
+                    if r.status_code == 206:
+                        total = _content_range_total(r.headers.get('Content-Range'))
+                        if meta.get('total') is not None and total != meta['total']:
+                            print("   Remote file changed, restarting download...")
+                            _discard_partial_download(dest)
+                            continue
+                        print(f"   Resuming download at {start / 1024 / 1024:.0f}MB...")
+                    else:
+                        if start > 0:
+                            # If-Range didn't match (new file) or no Range support
+                            print("   Remote file changed or resuming unsupported, restarting download...")
+                            start = 0
+                        length = r.headers.get('Content-Length')
+                        total = int(length) if length else None
+
+                        # Remember which remote file this partial download belongs to
+                        etag = r.headers.get('ETag')
+                        with open(_download_meta_file(dest), 'w', encoding='utf-8') as f:
+                            json.dump({
+                                # If-Range only accepts strong ETags
+                                'etag': etag if etag and not etag.startswith('W/') else None,
+                                'last_modified': r.headers.get('Last-Modified'),
+                                'total': total,
+                            }, f)
+
+                    done = start
+
+                    with open(dest, 'ab' if start > 0 else 'wb') as f:
+                        for chunk in r.iter_content(chunk_size=1 << 20):
+                            f.write(chunk)
+                            done += len(chunk)
+                            if total:
+                                print(f"\r   {done / 1024 / 1024:.0f}/{total / 1024 / 1024:.0f}MB "
+                                      f"({done * 100 // total}%)", end='', flush=True)
+                    print()
+
+                size = dest.stat().st_size
+                if total is None or size == total:
+                    return
+                if size > total:
+                    _discard_partial_download(dest)
+                    raise IOError(f"downloaded {size} bytes, expected {total}")
+                # The server closed the connection early; resume below
+                raise requests.exceptions.ConnectionError(f"connection closed after {size} of {total} bytes")
+            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.Timeout) as e:
+                print()
+                if attempt == DOWNLOAD_RETRIES:
+                    raise
+                print(f"   ⚠️  Download interrupted ({e}), retrying in {DOWNLOAD_RETRY_DELAY}s "
+                      f"(attempt {attempt + 1}/{DOWNLOAD_RETRIES})...")
+                time.sleep(DOWNLOAD_RETRY_DELAY)
+
+        raise IOError("could not download a consistent copy of the file")
+
+
+def download_puzzle_database(keep_csv: bool = False) -> Path:
+    """Download the Lichess puzzle database (kept zstd-compressed on disk).
+
+    Older versions of this script decompressed the database to a ~3.5GB
+    .csv next to it. That copy is no longer read, so it is removed unless
+    keep_csv is set, in which case it is (re)created from the .zst.
+    """
     DOWNLOAD_DIR.mkdir(parents=True, exist_ok=True)
     
     compressed_file = DOWNLOAD_DIR / "lichess_db_puzzle.csv.zst"
+    partial_file = DOWNLOAD_DIR / "lichess_db_puzzle.csv.zst.part"
     decompressed_file = DOWNLOAD_DIR / "lichess_db_puzzle.csv"
     
-    # Check if already downloaded and decompressed
-    if decompressed_file.exists():
-        print(f"✅ Puzzle database already exists at {decompressed_file}")
-        return decompressed_file
+    if decompressed_file.exists() and not keep_csv:
+        print(f"🧹 Removing decompressed copy {decompressed_file} (reading the .zst directly)")
+        decompressed_file.unlink()
     
-    # Download if not exists
-    if not compressed_file.exists():
+    # Check if already downloaded
+    if compressed_file.exists():
+        print(f"✅ Puzzle database already exists at {compressed_file}")
+    else:
         print(f"📥 Downloading Lichess puzzle database from {LICHESS_PUZZLE_URL}")
         print("   This may take several minutes (file is ~500MB compressed)...")
         
+        # Download into a .part file so an interrupted run can be resumed
         try:
-            urllib.request.urlretrieve(LICHESS_PUZZLE_URL, compressed_file)
+            _download_with_resume(LICHESS_PUZZLE_URL, partial_file)
+            partial_file.rename(compressed_file)
+            _discard_partial_download(partial_file)
             print(f"✅ Downloaded to {compressed_file}")
         except Exception as e:
             print(f"❌ Failed to download: {e}")
+            print("   Re-run the script to resume the download.")
             sys.exit(1)
     
-    # Decompress
-    print(f"📦 Decompressing {compressed_file.name}...")
-    print("   This may take several minutes (decompressed file is ~3.5GB)...")
-    
-    try:
-        subprocess.check_call(["zstd", "-d", str(compressed_file), "-o", str(decompressed_file)])
+    # (Re)create the CSV if it is missing or predates the downloaded .zst
+    if keep_csv and (not decompressed_file.exists() or
+                     decompressed_file.stat().st_mtime < compressed_file.stat().st_mtime):
+        print(f"📦 Decompressing {compressed_file.name} (--keep-csv)...")
+        print("   This may take several minutes (decompressed file is ~3.5GB)...")
+        try:
+            _decompress_to_file(compressed_file, decompressed_file)
+        except (TruncatedDatabaseError, zstandard.ZstdError) as e:
+            print(f"❌ The puzzle database at {compressed_file} is incomplete or corrupt: {e}")
+            print("   Delete it and re-run the script to download it again.")
+            sys.exit(1)
         print(f"✅ Decompressed to {decompressed_file}")
-    except subprocess.CalledProcessError as e:
-        print(f"❌ Failed to decompress: {e}")
-        sys.exit(1)
     
-    return decompressed_file
+    return compressed_file
 
 
-def extract_puzzles_for_pattern(csv_file: Path, pattern: str, themes: List[str], max_puzzles: int) -> List[Dict[str, Any]]:
-    """Extract high-quality puzzles for a specific tactical pattern."""
-    print(f"🔍 Extracting {pattern.upper()} puzzles (max: {max_puzzles})...")
+def _decompress_to_file(zst_file: Path, dest: Path):
+    """Decompress zst_file to dest, replacing dest only if the whole file decoded."""
+    temp_file = dest.with_name(dest.name + ".tmp")
+    read_size = DEFAULT_READ_BUFFER_MB * 1024 * 1024
+    try:
+        raw = open(zst_file, 'rb', buffering=0)
+        compressed = io.BufferedReader(raw, buffer_size=read_size)
+        with _CheckedZstdReader(compressed, zstandard.ZstdDecompressor(), read_size // 4) as src, \
+                open(temp_file, 'wb') as dst:
+            shutil.copyfileobj(src, dst, read_size)
+        temp_file.replace(dest)
+    finally:
+        if temp_file.exists():
+            temp_file.unlink()
 
-    puzzles = []
 
-    with open(csv_file, 'r', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
+class TruncatedDatabaseError(Exception):
+    """The compressed puzzle database ends in the middle of a zstd frame."""
 
-        for row in reader:
-            puzzle_themes = row['Themes'].split()
-            rating = int(row['Rating'])
-            popularity = int(row['Popularity'])
-            nb_plays = int(row['NbPlays'])
 
-            # Check if puzzle matches our criteria
-            if (any(theme in puzzle_themes for theme in themes) and
-                popularity >= MIN_POPULARITY and
-                MIN_RATING <= rating <= MAX_RATING and
-                nb_plays >= MIN_PLAYS):
+class _CheckedZstdReader(io.RawIOBase):
+    """Raw stream that decompresses zstd frames and rejects truncated input.
 
-                puzzles.append(row)
+    zstandard's stream_reader() silently reports EOF when the input stops
+    mid-frame, so a partially downloaded database would look complete. This
+    reader decompresses frame by frame and raises TruncatedDatabaseError if
+    the compressed file does not end on a frame boundary.
+    """
 
-                # Stop when we have enough
-                if len(puzzles) >= max_puzzles:
-                    break
+    def __init__(self, source: io.BufferedReader, dctx: zstandard.ZstdDecompressor, read_size: int):
+        self._source = source
+        self._dctx = dctx
+        self._read_size = read_size
+        self._dobj = dctx.decompressobj()
+        self._in_frame = False
+        self._frames = 0
+        self._pending = memoryview(b'')
 
-    # Sort by popularity (best first)
-    puzzles.sort(key=lambda x: int(x['Popularity']), reverse=True)
+    def readable(self) -> bool:
+        return True
+
+    def _decompress(self, data: bytes) -> bytes:
+        out = []
+        while data:
+            out.append(self._dobj.decompress(data))
+            if self._dobj.eof:
+                # A decompressobj handles one frame; continue with the rest
+                data = self._dobj.unused_data
+                self._dobj = self._dctx.decompressobj()
+                self._in_frame = False
+                self._frames += 1
+            else:
+                self._in_frame = True
+                data = b''
+        return b''.join(out)
+
+    def readinto(self, b) -> int:
+        while not self._pending:
+            chunk = self._source.read(self._read_size)
+            if not chunk:
+                if self._in_frame or not self._frames:
+                    raise TruncatedDatabaseError("compressed data ends before a complete zstd frame")
+                return 0
+            self._pending = memoryview(self._decompress(chunk))
+
+        n = min(len(b), len(self._pending))
+        b[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        return n
+
+    def close(self):
+        self._source.close()
+        super().close()
+
+
+def open_puzzle_csv(zst_file: Path, dctx: zstandard.ZstdDecompressor, read_buffer_mb: int = DEFAULT_READ_BUFFER_MB) -> io.TextIOWrapper:
+    """Open the compressed puzzle database as a text stream for csv readers.
+
+    The CSV is decompressed on the fly, so the ~3.5GB plain-text copy never
+    has to be written to (and re-read from) disk. The compressed file is read
+    in large sequential chunks to keep spinning disks from seeking. Reading
+    past the end of a truncated file raises TruncatedDatabaseError.
+    """
+    buffer_size = read_buffer_mb * 1024 * 1024
+    raw = open(zst_file, 'rb', buffering=0)
+    compressed = io.BufferedReader(raw, buffer_size=buffer_size)
+    reader = _CheckedZstdReader(compressed, dctx, read_size=max(buffer_size // 4, 1 << 20))
+    decompressed = io.BufferedReader(reader, buffer_size=max(buffer_size // 2, 1 << 20))
+    return io.TextIOWrapper(decompressed, encoding='utf-8', newline='')
+
+
+def _iter_quality_rows(f: io.TextIOWrapper) -> Iterator[Tuple[str, str, str, str, str, str]]:
+    """Yield (id, fen, moves, rating, popularity, themes) for rows passing the quality criteria."""
+    # Plain csv.reader avoids building a dict for every row; resolve
+    # the column positions from the header once instead
+    reader = csv.reader(f)
+    header = next(reader)
+    idx = {name: i for i, name in enumerate(header)}
+    idx_puzzle_id = idx['PuzzleId']
+    idx_fen = idx['FEN']
+    idx_moves = idx['Moves']
+    idx_rating = idx['Rating']
+    idx_popularity = idx['Popularity']
+    idx_plays = idx['NbPlays']
+    idx_themes = idx['Themes']
+
+    # The numeric columns are unpadded ASCII integers, so many rejects can
+    # be decided from the sign or digit count without calling int()
+    reject_negative_popularity = MIN_POPULARITY > 0
+    min_rating_digits = len(str(MIN_RATING))
+    max_rating_digits = len(str(MAX_RATING))
+    min_plays_digits = len(str(MIN_PLAYS))
+
+    for fields in reader:
+        # Cheap numeric checks first - most rows are rejected here,
+        # before the caller pays for splitting the themes
+        popularity = fields[idx_popularity]
+        if reject_negative_popularity and popularity.startswith('-'):
+            continue
+        if int(popularity) < MIN_POPULARITY:
+            continue
+
+        rating = fields[idx_rating]
+        if not min_rating_digits <= len(rating) <= max_rating_digits:
+            continue
+        if not MIN_RATING <= int(rating) <= MAX_RATING:
+            continue
+
+        plays = fields[idx_plays]
+        if len(plays) < min_plays_digits or int(plays) < MIN_PLAYS:
+            continue
 
-    print(f"   Found {len(puzzles)} high-quality {pattern.upper()} puzzles")
-    return puzzles[:max_puzzles]
+        yield (fields[idx_puzzle_id], fields[idx_fen], fields[idx_moves],
+               rating, popularity, fields[idx_themes])
+
+
+def _iter_quality_rows_pandas(f: io.TextIOWrapper) -> Iterator[Tuple[str, str, str, str, str, str]]:
+    """Same as _iter_quality_rows, but filters whole chunks with pandas boolean masks."""
+    chunks = pandas.read_csv(
+        f,
+        usecols=['PuzzleId', 'FEN', 'Moves', 'Rating', 'Popularity', 'NbPlays', 'Themes'],
+        dtype={'PuzzleId': str, 'FEN': str, 'Moves': str, 'Themes': str,
+               'Rating': 'int32', 'Popularity': 'int16', 'NbPlays': 'int32'},
+        keep_default_na=False,
+        chunksize=PANDAS_CHUNK_SIZE,
+    )
+    with chunks:
+        for chunk in chunks:
+            mask = ((chunk.Popularity >= MIN_POPULARITY) &
+                    chunk.Rating.between(MIN_RATING, MAX_RATING) &
+                    (chunk.NbPlays >= MIN_PLAYS))
+            sub = chunk[mask]
+
+            # Only the few surviving rows go back to per-row Python work
+            for puzzle_id, fen, moves, rating, popularity, themes in zip(
+                    sub.PuzzleId, sub.FEN, sub.Moves, sub.Rating, sub.Popularity, sub.Themes):
+                yield puzzle_id, fen, moves, str(rating), str(popularity), themes
+
+
+def extract_all_puzzles(zst_file: Path, dctx: zstandard.ZstdDecompressor, max_puzzles: int, read_buffer_mb: int = DEFAULT_READ_BUFFER_MB, most_popular: bool = False) -> Iterator[Tuple[str, Optional[Dict[str, Any]]]]:
+    """Extract high-quality puzzles for every tactical pattern in a single pass.
+
+    Each row is classified against all patterns at once, so the database is
+    only read and parsed one time no matter how many patterns we collect.
+
+    By default the first max_puzzles matches of each pattern are taken, so
+    the scan stops as soon as every pattern has enough. With most_popular
+    the whole database is scanned instead and each pattern keeps its
+    max_puzzles most popular rows in a bounded min-heap.
+
+    Yields (pattern, row) for every selected row, and (pattern, None) once
+    that pattern will receive no more rows. By default rows are yielded as
+    soon as they are accepted; with most_popular nothing is yielded until
+    the full scan has finished.
+    """
+    mode = "most popular" if most_popular else "first matches"
+    print(f"🔍 Extracting puzzles for {len(PATTERN_THEMES)} patterns (max: {max_puzzles} {mode} each)...")
+
+    # Themes that still feed at least one unfilled pattern, as a bitmask
+    # plus a tuple used as a cheap substring prefilter before splitting
+    active_mask = ALL_THEMES_MASK
+    theme_prefilter = tuple(THEME_BITS)
+
+    remaining = {p: max_puzzles for p in PATTERN_THEMES}
+    unfilled = len(PATTERN_THEMES)
+
+    # Min-heaps of (popularity, -sequence, row); the sequence number breaks
+    # ties deterministically in favour of the row seen first
+    heaps: Dict[str, List[Tuple[int, int, Dict[str, Any]]]] = {p: [] for p in PATTERN_THEMES}
+
+    with open_puzzle_csv(zst_file, dctx, read_buffer_mb) as f:
+        candidates = _iter_quality_rows_pandas(f) if pandas is not None else _iter_quality_rows(f)
+
+        for seq, (puzzle_id, fen, moves, rating, popularity, themes) in enumerate(candidates):
+            if not any(t in themes for t in theme_prefilter):
+                continue
+
+            # Unknown themes contribute no bits
+            row_mask = 0
+            for t in themes.split():
+                row_mask |= THEME_BITS.get(t, 0)
+            row_mask &= active_mask
+            if not row_mask:
+                continue
+
+            # Only keep the columns lichess_to_fixture needs
+            row = {
+                'PuzzleId': puzzle_id,
+                'FEN': fen,
+                'Moves': moves,
+                'Rating': rating,
+                'Popularity': popularity,
+                'Themes': themes,
+            }
+
+            # One AND per pattern; a pattern matching several of the row's
+            # themes (e.g. double_attack) still only sees the row once
+            for p, pattern_mask in PATTERN_MASKS.items():
+                if not row_mask & pattern_mask:
+                    continue
+
+                if most_popular:
+                    entry = (int(popularity), -seq, row)
+                    heap = heaps[p]
+                    if len(heap) < max_puzzles:
+                        heapq.heappush(heap, entry)
+                    elif entry > heap[0]:
+                        heapq.heapreplace(heap, entry)
+                elif remaining[p]:
+                    remaining[p] -= 1
+                    yield p, row
+                    if not remaining[p]:
+                        unfilled -= 1
+                        # Rows carrying only full patterns' themes can now
+                        # be rejected before the dispatch loop
+                        active_mask = 0
+                        for q, left in remaining.items():
+                            if left:
+                                active_mask |= PATTERN_MASKS[q]
+                        theme_prefilter = tuple(t for t, bit in THEME_BITS.items() if bit & active_mask)
+                        yield p, None
+
+            # Stop reading as soon as every pattern has enough
+            if not most_popular and unfilled == 0:
+                break
+
+    if most_popular:
+        for p, heap in heaps.items():
+            for _, _, row in sorted(heap, reverse=True):
+                yield p, row
+            yield p, None
+    else:
+        # Patterns that never filled up are complete once the file is exhausted
+        for p, left in remaining.items():
+            if left:
+                yield p, None
+
+
+@lru_cache(maxsize=4096)
+def _uci(move_uci: str) -> chess.Move:
+    """Parse a UCI move string, caching the common ones (castling, promotions...).
+
+    Safe to share because board.push() never mutates the Move it is given.
+    """
+    return chess.Move.from_uci(move_uci)
 
 
 def lichess_to_fixture(puzzle_row: Dict[str, Any], pattern_type: str) -> Dict[str, Any]:
@@ -185,15 +573,17 @@ def lichess_to_fixture(puzzle_row: Dict[str, Any], pattern_type: str) -> Dict[st
     """
     fen = puzzle_row['FEN']
     moves_uci = puzzle_row['Moves'].split()
+    if len(moves_uci) < 2:
+        raise ValueError("puzzle has no solution moves")
 
     # Apply first move (opponent's move) to get starting position
     board = chess.Board(fen)
-    opponent_move = chess.Move.from_uci(moves_uci[0])
+    opponent_move = _uci(moves_uci[0])
     board.push(opponent_move)
     initial_fen = board.fen()
 
-    # Determine side to move from initial FEN
-    side_to_move = "white" if " w " in initial_fen else "black"
+    # Determine side to move from the board itself
+    side_to_move = "white" if board.turn == chess.WHITE else "black"
 
     # Process all moves in the sequence
     # moves_uci[0] = opponent's setup move (already applied)
@@ -204,8 +594,14 @@ def lichess_to_fixture(puzzle_row: Dict[str, Any], pattern_type: str) -> Dict[st
 
     move_sequence = []
     for i, move_uci in enumerate(moves_uci[1:], start=1):  # Skip first move (already applied)
-        move = chess.Move.from_uci(move_uci)
-        move_san = board.san(move)
+        # san_and_push() works out check/mate suffixes from the position it
+        # pushes, instead of san() pushing and popping the move just for that
+        move_san = board.san_and_push(_uci(move_uci))
+
+        # First player move (for backward compatibility)
+        if i == 1:
+            first_player_move_san = move_san
+            first_player_move_uci = move_uci
 
         # Determine who makes this move
         # Odd indices (1, 3, 5...) = player moves
@@ -218,17 +614,9 @@ def lichess_to_fixture(puzzle_row: Dict[str, Any], pattern_type: str) -> Dict[st
             "player": is_player_move
         })
 
-        board.push(move)
-
     # Get final position after all moves
     resulting_fen = board.fen()
 
-    # First player move (for backward compatibility)
-    first_player_move_uci = moves_uci[1]
-    board_temp = chess.Board(initial_fen)
-    first_player_move = chess.Move.from_uci(first_player_move_uci)
-    first_player_move_san = board_temp.san(first_player_move)
-
     return {
         "id": puzzle_row['PuzzleId'],
         "initialFen": initial_fen,
@@ -249,23 +637,153 @@ def lichess_to_fixture(puzzle_row: Dict[str, Any], pattern_type: str) -> Dict[st
     }
 
 
-def save_fixtures(pattern: str, fixtures: List[Dict[str, Any]]):
-    """Save fixtures to JSON file."""
-    FIXTURES_DIR.mkdir(parents=True, exist_ok=True)
+def _convert_one(pattern_type: str, puzzle_row: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Convert a single puzzle in a worker process, returning None on failure.
 
-    output_file = FIXTURES_DIR / f"{pattern}.json"
+    Lives at module level so it can be pickled for ProcessPoolExecutor.
+    """
+    try:
+        return lichess_to_fixture(puzzle_row, pattern_type)
+    except Exception as e:
+        print(f"   ⚠️  Skipping puzzle {puzzle_row['PuzzleId']}: {e}")
+        return None
 
-    fixture_data = {
-        "description": f"High-quality {pattern.upper()} tactical puzzles from Lichess database",
-        "source": "https://database.lichess.org/",
-        "generatedAt": "auto-generated",
-        "cases": fixtures
-    }
 
-    with open(output_file, 'w', encoding='utf-8') as f:
-        json.dump(fixture_data, f, indent=2, ensure_ascii=False)
+def _encode_fixture(fixture: Dict[str, Any]) -> str:
+    """Encode one fixture as indent=2 JSON, using orjson when installed."""
+    if orjson is not None:
+        return orjson.dumps(fixture, option=orjson.OPT_INDENT_2).decode('utf-8')
+    return json.dumps(fixture, indent=2, ensure_ascii=False)
 
-    print(f"✅ Saved {len(fixtures)} puzzles to {output_file}")
+
+class FixtureWriter:
+    """Stream fixtures into a pattern's JSON file one case at a time.
+
+    Produces the same layout as json.dump(..., indent=2) of the whole
+    fixture object, encoding one case at a time instead of building the
+    complete JSON document as a single string. This streams the encoding
+    only; the caller still holds the pattern's converted fixtures (at most
+    --max-puzzles of them) until they are written. The file is written next
+    to the target and only moved into place once at least one case was
+    written, so a failed run keeps the old fixtures.
+    """
+
+    def __init__(self, pattern: str):
+        self.pattern = pattern
+        self.output_file = FIXTURES_DIR / f"{pattern}.json"
+        self.temp_file = self.output_file.with_name(self.output_file.name + ".tmp")
+        self.count = 0
+        self._f = None
+
+    def __enter__(self) -> "FixtureWriter":
+        FIXTURES_DIR.mkdir(parents=True, exist_ok=True)
+
+        header = {
+            "description": f"High-quality {self.pattern.upper()} tactical puzzles from Lichess database",
+            "source": "https://database.lichess.org/",
+            "generatedAt": "auto-generated",
+        }
+
+        self._f = open(self.temp_file, 'w', encoding='utf-8')
+        self._f.write("{\n")
+        for key, value in header.items():
+            self._f.write(f"  {json.dumps(key)}: {json.dumps(value, ensure_ascii=False)},\n")
+        self._f.write('  "cases": [')
+        return self
+
+    def write(self, fixture: Dict[str, Any]):
+        """Append one fixture to the cases array."""
+        encoded = _encode_fixture(fixture).replace("\n", "\n    ")
+        self._f.write(("," if self.count else "") + "\n    " + encoded)
+        self.count += 1
+
+    def __exit__(self, exc_type, exc, tb):
+        self._f.write("\n  ]\n}" if self.count else "]\n}")
+        self._f.close()
+
+        if exc_type is None and self.count:
+            self.temp_file.replace(self.output_file)
+            print(f"✅ Saved {self.count} puzzles to {self.output_file}")
+        else:
+            self.temp_file.unlink()
+        return False
+
+
+def save_fixtures_streaming(pattern: str) -> FixtureWriter:
+    """Open a streaming writer for a pattern's fixture file."""
+    return FixtureWriter(pattern)
+
+
+def _save_pattern(pattern: str, pending: List[Tuple[int, Future]]) -> int:
+    """Write a completed pattern's converted fixtures, best puzzles first."""
+    print(f"   Found {len(pending)} high-quality {pattern.upper()} puzzles")
+    if not pending:
+        print(f"⚠️  Warning: No puzzles found for {pattern.upper()}")
+        return 0
+
+    # Sort by popularity (best first)
+    pending.sort(key=lambda item: item[0], reverse=True)
+
+    with save_fixtures_streaming(pattern) as writer:
+        for _, future in pending:
+            fixture = future.result()
+            if fixture is not None:
+                writer.write(fixture)
+    return writer.count
+
+
+def convert_all_puzzles(zst_file: Path, dctx: zstandard.ZstdDecompressor, max_puzzles: int, read_buffer_mb: int = DEFAULT_READ_BUFFER_MB, most_popular: bool = False) -> int:
+    """Extract, convert and save puzzles for every pattern as one pipeline.
+
+    A producer thread decompresses, parses and filters the database (zstd
+    releases the GIL while decoding) while a process pool replays the move
+    sequences, so wall time is roughly the slower of the two rather than
+    their sum. Each pattern's file is written as soon as its bucket is
+    complete. With most_popular no rows arrive until the whole database has
+    been scanned, so conversion only starts after extraction and every file
+    is written at the end. Returns the total number of fixtures saved.
+    """
+    rows: "queue.Queue[Any]" = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    done = object()
+
+    def produce():
+        try:
+            for item in extract_all_puzzles(zst_file, dctx, max_puzzles, read_buffer_mb, most_popular):
+                rows.put(item)
+        except BaseException as e:
+            rows.put(e)
+        else:
+            rows.put(done)
+
+    producer = threading.Thread(target=produce, name="puzzle-extractor", daemon=True)
+    producer.start()
+
+    pending: Dict[str, List[Tuple[int, Future]]] = {p: [] for p in PATTERN_THEMES}
+    total_puzzles = 0
+
+    # Replaying the move sequences is pure Python CPU work, so convert
+    # puzzles across all cores while extraction continues. Workers must not
+    # be fork()ed from this process while the extractor thread is running,
+    # so start them from a clean forkserver (or spawn where unavailable)
+    start_methods = multiprocessing.get_all_start_methods()
+    mp_context = multiprocessing.get_context('forkserver' if 'forkserver' in start_methods else 'spawn')
+    with ProcessPoolExecutor(mp_context=mp_context) as executor:
+        while True:
+            item = rows.get()
+            if item is done:
+                break
+            if isinstance(item, BaseException):
+                raise item
+
+            pattern, row = item
+            if row is None:
+                total_puzzles += _save_pattern(pattern, pending.pop(pattern))
+            else:
+                future = executor.submit(_convert_one, pattern, row)
+                pending[pattern].append((int(row['Popularity']), future))
+
+    producer.join()
+    return total_puzzles
 
 
 def create_setup_marker():
@@ -301,6 +819,22 @@ Examples:
         default=DEFAULT_PUZZLES_PER_PATTERN,
         help=f'Maximum number of puzzles to extract per pattern (default: {DEFAULT_PUZZLES_PER_PATTERN})'
     )
+    parser.add_argument(
+        '--read-buffer-mb',
+        type=int,
+        default=DEFAULT_READ_BUFFER_MB,
+        help=f'Read buffer size in MB for the compressed database (default: {DEFAULT_READ_BUFFER_MB})'
+    )
+    parser.add_argument(
+        '--most-popular',
+        action='store_true',
+        help='Take the most popular matching puzzles instead of the first ones (scans the whole database)'
+    )
+    parser.add_argument(
+        '--keep-csv',
+        action='store_true',
+        help='Also keep a decompressed copy of the database in downloads/ (~3.5GB)'
+    )
     parser.add_argument(
         '--force',
         action='store_true',
@@ -309,6 +843,11 @@ Examples:
 
     args = parser.parse_args()
 
+    if args.max_puzzles < 1:
+        parser.error('--max-puzzles must be at least 1')
+    if args.read_buffer_mb < 1:
+        parser.error('--read-buffer-mb must be at least 1')
+
     print("=" * 70)
     print("🎯 Chess Tutor - Tactical Puzzles Setup")
     print("=" * 70)
@@ -326,48 +865,24 @@ Examples:
         else:
             SETUP_MARKER.unlink()
 
-    # Step 1: Check/install zstd
-    print("Step 1: Checking dependencies...")
-    if not check_zstd_installed():
-        print("⚠️  zstd not found (required for decompression)")
-        install_zstd()
-    else:
-        print("✅ zstd is installed")
+    # Step 1: Download database
+    print("Step 1: Downloading Lichess puzzle database...")
+    zst_file = download_puzzle_database(args.keep_csv)
     print()
 
-    # Step 2: Download and decompress database
-    print("Step 2: Downloading Lichess puzzle database...")
-    csv_file = download_puzzle_database()
-    print()
-
-    # Step 3: Extract puzzles for each pattern
-    print("Step 3: Extracting puzzles for each tactical pattern...")
-    total_puzzles = 0
-    for pattern, themes in PATTERN_THEMES.items():
-        puzzles = extract_puzzles_for_pattern(csv_file, pattern, themes, args.max_puzzles)
-
-        if len(puzzles) == 0:
-            print(f"⚠️  Warning: No puzzles found for {pattern.upper()}")
-            continue
-
-        # Convert to fixture format
-        fixtures = []
-        for puzzle in puzzles:
-            try:
-                fixture = lichess_to_fixture(puzzle, pattern)
-                fixtures.append(fixture)
-            except Exception as e:
-                print(f"   ⚠️  Skipping puzzle {puzzle['PuzzleId']}: {e}")
-
-        # Save to file
-        if fixtures:
-            save_fixtures(pattern, fixtures)
-            total_puzzles += len(fixtures)
-
+    # Step 2: Extract puzzles for each pattern
+    print("Step 2: Extracting puzzles for each tactical pattern...")
+    dctx = zstandard.ZstdDecompressor()
+    try:
+        total_puzzles = convert_all_puzzles(zst_file, dctx, args.max_puzzles, args.read_buffer_mb, args.most_popular)
+    except (TruncatedDatabaseError, zstandard.ZstdError) as e:
+        print(f"❌ The puzzle database at {zst_file} is incomplete or corrupt: {e}")
+        print("   Delete it and re-run the script to download it again.")
+        sys.exit(1)
     print()
 
-    # Step 4: Create marker file
-    print("Step 4: Finalizing setup...")
+    # Step 3: Create marker file
+    print("Step 3: Finalizing setup...")
     create_setup_marker()
     print()
 